@@ -1,150 +1,370 @@
 import json
 import ollama
 import asyncio
+import atexit
+import functools
 import os
 import subprocess
 import shlex
 import shutil
 import logging
+import logging.handlers
+import queue
 import sys
-import platform
-from typing import Any, Dict, List
-from datetime import datetime
+import stat
+import time
+from typing import Any, Callable, Dict, List, Optional
+from pathlib import Path
+
+# pwd and grp are only available on Unix; owners are shown as numeric IDs elsewhere
+try:
+    import grp
+    import pwd
+except ImportError:
+    grp = pwd = None
+
+# psutil is optional; it lists processes on systems without /proc
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# uvloop is optional; it replaces the default asyncio event loop with a faster one
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# orjson is optional; it parses the error details straight from bytes, faster than json
+try:
+    import orjson
+
+    def loads_json(data: bytes) -> Any:
+        return orjson.loads(data)
+except ImportError:
+    def loads_json(data: bytes) -> Any:
+        return json.loads(data)
+
+# Configure logging; set ZSH_LLM_DEBUG_LEVEL=DEBUG for verbose output
+LOG_LEVEL_NAME = (os.getenv('ZSH_LLM_DEBUG_LEVEL') or 'WARNING').upper()
+LOG_LEVEL = getattr(logging, LOG_LEVEL_NAME, None)
+if not isinstance(LOG_LEVEL, int):
+    # Unknown names, and attributes of logging that are not levels, fall back to WARNING
+    LOG_LEVEL = logging.WARNING
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+log_handlers: List[logging.Handler] = [logging.StreamHandler(sys.stdout)]  # Log to console
+
+if LOG_LEVEL <= logging.DEBUG:
+    # Log to a file from a background thread, so that callers never wait on disk I/O
+    file_handler = logging.FileHandler("shell_debugger.log")
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue, file_handler)
+    log_listener.start()
+    # Registered after logging's own exit handler, so it runs first and drains the queue
+    atexit.register(log_listener.stop)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # The file handler applies LOG_FORMAT; only the message is prepared here
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    log_handlers.append(queue_handler)
 
-# Configure logging for verbose output
 logging.basicConfig(
-    level=logging.DEBUG,  # Set to DEBUG for verbose logging
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),  # Log to console
-        logging.FileHandler("shell_debugger.log")  # Log to a file
-    ]
+    level=LOG_LEVEL,
+    format=LOG_FORMAT,
+    handlers=log_handlers
 )
 
+logger = logging.getLogger(__name__)
+
+# Values that stay the same for the lifetime of the process
+ENV_SHELL = os.getenv('SHELL', '')
+ENV_PATH = os.getenv('PATH', '')
+HAS_PROC = os.path.isdir('/proc')
+
+@functools.lru_cache(maxsize=None)
+def which(command: str) -> Optional[str]:
+    """
+    Memoized shutil.which, so that each command is looked up on PATH only once.
+    """
+    return shutil.which(command)
+
+# Subprocesses are started with close_fds=False and an absolute executable path,
+# which lets CPython 3.8+ spawn them with posix_spawn instead of fork+exec.
+# Descriptors opened by Python are non-inheritable (PEP 446), so none leak into
+# the child. Passing preexec_fn, cwd, pass_fds or start_new_session, or a bare
+# executable name, falls back to fork+exec.
+
 # Function Definitions
 
+def user_name(uid: int) -> str:
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except (AttributeError, KeyError):
+        return str(uid)
+
+def group_name(gid: int) -> str:
+    try:
+        return grp.getgrgid(gid).gr_name
+    except (AttributeError, KeyError):
+        return str(gid)
+
+def format_long_listing(name: str, st: os.stat_result, target: Optional[str] = None) -> str:
+    """
+    Formats a single directory entry the way `ls -la` does.
+    """
+    modified = time.strftime('%b %d %H:%M', time.localtime(st.st_mtime))
+    line = (
+        f"{stat.filemode(st.st_mode)} {st.st_nlink:>3} {user_name(st.st_uid)} "
+        f"{group_name(st.st_gid)} {st.st_size:>8} {modified} {name}"
+    )
+    if target is not None:
+        line += f" -> {target}"
+    return line
+
+def scan_directory(path: str, long_format: bool) -> str:
+    """
+    Lists a directory with os.scandir, mimicking `ls` or, with long_format, `ls -la`.
+    """
+    if not os.path.isdir(path):
+        # Like ls, list a single file by name; lstat raises if it does not exist
+        st = os.lstat(path)
+        return (format_long_listing(path, st) if long_format else path) + '\n'
+    with os.scandir(path) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    if not long_format:
+        lines = [entry.name for entry in entries if not entry.name.startswith('.')]
+    else:
+        lines = [format_long_listing(name, os.lstat(os.path.join(path, name))) for name in ('.', '..')]
+        for entry in entries:
+            target = os.readlink(entry.path) if entry.is_symlink() else None
+            lines.append(format_long_listing(entry.name, entry.stat(follow_symlinks=False), target))
+    return ''.join(line + '\n' for line in lines)
+
 def list_directory(path: str, options: List[str] = []) -> str:
-    logging.debug(f"Entering list_directory with path: {path}, options: {options}")
+    logger.debug("Entering list_directory with path: %s, options: %s", path, options)
     try:
-        # Determine the operating system
-        system = platform.system()
-        logging.debug(f"Operating System detected: {system}")
-        if system == "Windows":
-            cmd = ['dir', path] + options
-            shell = True
-            logging.debug(f"Constructed command for Windows: {' '.join(cmd)}")
+        if '--help' in options:
+            output = subprocess.run([which('ls') or 'ls', '--help'], capture_output=True, text=True, check=True, close_fds=False).stdout
         else:
-            cmd = ['ls', path] + options
-            shell = False
-            logging.debug(f"Constructed command for Unix: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True, shell=shell)
-        logging.debug(f"Command output:\n{result.stdout}")
-        return result.stdout
+            output = scan_directory(path, long_format='-la' in options)
+        logger.debug("Command output:\n%s", output)
+        return output
     except subprocess.CalledProcessError as e:
-        logging.error(f"Error listing directory: {e.stderr}")
+        logger.error("Error listing directory: %s", e.stderr)
         return f"Error listing directory: {e.stderr}"
+    except OSError as e:
+        logger.error("Error listing directory: %s", e)
+        return f"Error listing directory: {str(e)}"
     except Exception as e:
-        logging.exception("Unexpected error in list_directory")
+        logger.exception("Unexpected error in list_directory")
         return f"Unexpected error: {str(e)}"
 
 def print_working_directory() -> str:
-    logging.debug("Entering print_working_directory")
+    logger.debug("Entering print_working_directory")
     try:
         cwd = os.getcwd()
-        logging.debug(f"Current working directory: {cwd}")
+        logger.debug("Current working directory: %s", cwd)
         return cwd
     except Exception as e:
-        logging.exception("Error getting current working directory")
+        logger.exception("Error getting current working directory")
         return f"Error getting current working directory: {str(e)}"
 
+def read_proc_processes() -> str:
+    """
+    Lists running processes from /proc, like a condensed `ps aux`.
+    """
+    lines = [f"{'PID':>7} {'USER':<12} COMMAND"]
+    with os.scandir('/proc') as it:
+        pids = sorted((entry for entry in it if entry.name.isdigit()), key=lambda entry: int(entry.name))
+    for entry in pids:
+        try:
+            uid = entry.stat().st_uid
+            with open(os.path.join(entry.path, 'cmdline'), 'rb') as f:
+                command = f.read().replace(b'\0', b' ').strip().decode(errors='replace')
+            if not command:
+                # Kernel threads have no command line; ps shows their name in brackets
+                with open(os.path.join(entry.path, 'comm'), 'r') as f:
+                    command = f"[{f.read().strip()}]"
+        except OSError:
+            # The process exited while being read
+            continue
+        lines.append(f"{entry.name:>7} {user_name(uid):<12} {command}")
+    return ''.join(line + '\n' for line in lines)
+
+def read_psutil_processes() -> str:
+    """
+    Lists running processes with psutil, in the same format as read_proc_processes.
+    """
+    lines = [f"{'PID':>7} {'USER':<12} COMMAND"]
+    for process in psutil.process_iter(['pid', 'username', 'name', 'cmdline']):
+        info = process.info
+        command = ' '.join(info['cmdline'] or []) or f"[{info['name']}]"
+        lines.append(f"{info['pid']:>7} {info['username'] or '?':<12} {command}")
+    return ''.join(line + '\n' for line in lines)
+
 def list_processes(options: List[str] = []) -> str:
-    logging.debug(f"Entering list_processes with options: {options}")
+    logger.debug("Entering list_processes with options: %s", options)
     try:
-        # Determine the operating system
-        system = platform.system()
-        logging.debug(f"Operating System detected: {system}")
-        if system == "Windows":
-            cmd = ['tasklist'] + options
-            shell = True
-            logging.debug(f"Constructed command for Windows: {' '.join(cmd)}")
+        if '--help' not in options and HAS_PROC:
+            output = read_proc_processes()
+        elif '--help' not in options and psutil is not None:
+            # No /proc (e.g. macOS or Windows)
+            output = read_psutil_processes()
         else:
-            cmd = ['ps'] + options
-            shell = False
-            logging.debug(f"Constructed command for Unix: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True, shell=shell)
-        logging.debug(f"Command output:\n{result.stdout}")
-        return result.stdout
+            cmd = [which('ps') or 'ps'] + options
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Constructed command for Unix: %s", ' '.join(cmd))
+            output = subprocess.run(cmd, capture_output=True, text=True, check=True, close_fds=False).stdout
+        logger.debug("Command output:\n%s", output)
+        return output
     except subprocess.CalledProcessError as e:
-        logging.error(f"Error listing processes: {e.stderr}")
+        logger.error("Error listing processes: %s", e.stderr)
         return f"Error listing processes: {e.stderr}"
     except Exception as e:
-        logging.exception("Unexpected error in list_processes")
+        logger.exception("Unexpected error in list_processes")
         return f"Unexpected error: {str(e)}"
 
-def display_file_contents(file_path: str) -> str:
-    logging.debug(f"Entering display_file_contents with file_path: {file_path}")
+def display_file_contents(file_path: str, max_bytes: int = 64 * 1024) -> str:
+    """
+    Returns the contents of a file, reading at most max_bytes of it. Larger
+    regular files are cut down to their first and last max_bytes // 2 bytes;
+    files of unknown size, such as procfs files and devices, to their first
+    max_bytes.
+    """
+    logger.debug("Entering display_file_contents with file_path: %s", file_path)
     try:
-        with open(file_path, 'r') as file:
-            contents = file.read()
-        logging.debug(f"Contents of {file_path}:\n{contents}")
+        with open(file_path, 'rb') as file:
+            data = file.read(max_bytes + 1)
+            if len(data) > max_bytes:
+                st = os.fstat(file.fileno())
+                window = max_bytes // 2
+                if stat.S_ISREG(st.st_mode) and st.st_size > max_bytes:
+                    file.seek(-window, os.SEEK_END)
+                    marker = f"\n...[truncated {st.st_size - 2 * window} bytes]...\n"
+                    data = data[:window] + marker.encode() + file.read(window)
+                else:
+                    data = data[:max_bytes] + b"\n...[truncated]...\n"
+        contents = data.decode(errors='replace')
+        logger.debug("Contents of %s:\n%s", file_path, contents)
         return contents
     except FileNotFoundError:
-        logging.error(f"File not found: {file_path}")
+        logger.error("File not found: %s", file_path)
         return f"File not found: {file_path}"
     except Exception as e:
-        logging.exception(f"Error reading file: {file_path}")
+        logger.exception("Error reading file: %s", file_path)
         return f"Error reading file: {str(e)}"
 
-def execute_shell_command(command: str, env=os.environ) -> (str, str, int):
+# Characters that need the shell to interpret the command: operators,
+# expansions, tildes, assignments, history, comments, escapes and newlines
+SHELL_METACHARACTERS = frozenset('|&;<>$`(){}*?[]~=!#\\\n')
+
+def execute_shell_command(command: str, env: Optional[Dict[str, str]] = None) -> (str, str, int):
     """
     Executes a shell command and captures its output and exit status.
+    A plain command whose executable is on PATH is run directly; anything
+    else, including builtins, aliases and functions, goes through zsh. The
+    environment is inherited unless env is given.
     """
-    logging.debug(f"Executing shell command: {command}")
+    logger.debug("Executing shell command: %s", command)
     try:
+        argv = None
+        if SHELL_METACHARACTERS.isdisjoint(command):
+            try:
+                words = shlex.split(command)
+            except ValueError:
+                # Unbalanced quotes; let zsh report the error
+                words = []
+            if words:
+                executable = words[0] if os.sep in words[0] else which(words[0])
+                if executable:
+                    argv = [executable] + words[1:]
+        if argv is None:
+            argv = ['/bin/zsh', '-c', command]
         result = subprocess.run(
-            command,
-            shell=True,
+            argv,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             text=True,
-            executable='/bin/zsh',  # Ensure using ZSH
-            env=env
+            env=env,
+            close_fds=False
         )
-        logging.debug(f"Command executed with exit status: {result.returncode}")
-        logging.debug(f"STDOUT:\n{result.stdout}")
-        logging.debug(f"STDERR:\n{result.stderr}")
+        logger.debug("Command executed with exit status: %s", result.returncode)
+        logger.debug("STDOUT:\n%s", result.stdout)
+        logger.debug("STDERR:\n%s", result.stderr)
         return result.stdout, result.stderr, result.returncode
+    except FileNotFoundError as e:
+        # Match the shell's exit status for an unknown command
+        logger.error("Command not found: %s", e.filename)
+        return '', str(e), 127
     except Exception as e:
-        logging.exception("Error executing shell command")
+        logger.exception("Error executing shell command")
         return '', str(e), 1
 
-def gather_error_details(command: str, exit_status: int, stdout: str, stderr: str) -> Dict[str, Any]:
+# Environment variables worth sending to the model; everything else is dropped
+ENVIRONMENT_ALLOWLIST = ("SHELL", "PATH", "LANG", "TERM", "PWD", "HOME")
+
+async def get_command_output(*argv: str) -> str:
+    """
+    Runs a command without a shell and returns its combined output, like subprocess.getoutput.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *argv,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        close_fds=False
+    )
+    output, _ = await process.communicate()
+    return output.decode(errors='replace').rstrip('\n')
+
+def read_os_release() -> str:
+    try:
+        return Path('/etc/os-release').read_text().rstrip('\n')
+    except OSError:
+        return "OS release information not available"
+
+async def gather_error_details(command: str, exit_status: int, stdout: str, stderr: str) -> Dict[str, Any]:
     """
     Gathers detailed error information, including system and environment details.
+    The uname and --version subprocesses run concurrently.
     """
-    logging.debug("Gathering error details")
+    logger.debug("Gathering error details")
     try:
+        try:
+            binary = shlex.split(command)[0]
+        except (ValueError, IndexError):
+            # Unbalanced quotes or an empty command
+            binary = ''
+        binary_path = which(binary) if binary else None
+        uname_path = which('uname')
+
+        system_information, command_version = await asyncio.gather(
+            get_command_output(uname_path, '-a') if uname_path else asyncio.sleep(0, "System information not available"),
+            get_command_output(binary_path, '--version') if binary_path else asyncio.sleep(0, "Version information not available"),
+        )
+
         details = {
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": f"{time.time():.3f}",
             "command": command,
             "exit_status": exit_status,
             "stdout": stdout,
             "stderr": stderr,
             "working_directory": os.getcwd(),
-            "shell": os.getenv('SHELL', ''),
-            "PATH": os.getenv('PATH', ''),
-            "system_information": subprocess.getoutput('uname -a') if shutil.which('uname') else "System information not available",
-            "os_release": subprocess.getoutput('cat /etc/os-release') if os.path.exists('/etc/os-release') else "OS release information not available",
-            "command_binary_details": subprocess.getoutput(f'which {shlex.split(command)[0]}') if shutil.which(shlex.split(command)[0]) else "Command not found in PATH",
-            "command_version": subprocess.getoutput(f'{shlex.split(command)[0]} --version') if shutil.which(shlex.split(command)[0]) else "Version information not available",
-            "environment_variables": dict(os.environ)
+            "shell": ENV_SHELL,
+            "PATH": ENV_PATH,
+            "system_information": system_information,
+            "os_release": read_os_release(),
+            "command_binary_details": binary_path or "Command not found in PATH",
+            "command_version": command_version,
+            "environment_variables": {k: os.environ[k] for k in ENVIRONMENT_ALLOWLIST if k in os.environ}
         }
-        logging.debug(f"Error details gathered: {details}")
+        logger.debug("Error details gathered: %s", list(details))
         return details
     except Exception as e:
-        logging.exception("Error gathering error details")
+        logger.exception("Error gathering error details")
         return {
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": f"{time.time():.3f}",
             "command": command,
             "exit_status": exit_status,
             "stdout": stdout,
@@ -157,13 +377,13 @@ def gather_error_details(command: str, exit_status: int, stdout: str, stderr: st
 ALLOWED_FUNCTIONS: Dict[str, Dict[str, Any]] = {
     "list_directory": {
         "name": "list_directory",
-        "description": "List files and directories in a specified path.",
+        "description": "List a directory.",
         "parameters": {
             "type": "object",
             "properties": {
                 "path": {
                     "type": "string",
-                    "description": "The directory path to list."
+                    "description": "Directory path."
                 },
                 "options": {
                     "type": "array",
@@ -171,7 +391,7 @@ ALLOWED_FUNCTIONS: Dict[str, Dict[str, Any]] = {
                         "type": "string",
                         "enum": ["-la", "--help"]
                     },
-                    "description": "Options to modify the behavior of the ls command."
+                    "description": "ls options."
                 }
             },
             "required": ["path"]
@@ -179,7 +399,7 @@ ALLOWED_FUNCTIONS: Dict[str, Dict[str, Any]] = {
     },
     "print_working_directory": {
         "name": "print_working_directory",
-        "description": "Print the current working directory.",
+        "description": "Print the working directory.",
         "parameters": {
             "type": "object",
             "properties": {}
@@ -187,7 +407,7 @@ ALLOWED_FUNCTIONS: Dict[str, Dict[str, Any]] = {
     },
     "list_processes": {
         "name": "list_processes",
-        "description": "List currently running processes.",
+        "description": "List running processes.",
         "parameters": {
             "type": "object",
             "properties": {
@@ -197,20 +417,20 @@ ALLOWED_FUNCTIONS: Dict[str, Dict[str, Any]] = {
                         "type": "string",
                         "enum": ["aux", "--help"]
                     },
-                    "description": "Options to modify the behavior of the ps command."
+                    "description": "ps options."
                 }
             }
         }
     },
     "display_file_contents": {
         "name": "display_file_contents",
-        "description": "Display the contents of a specified file.",
+        "description": "Show a file's contents.",
         "parameters": {
             "type": "object",
             "properties": {
                 "file_path": {
                     "type": "string",
-                    "description": "The path to the file to display."
+                    "description": "File path."
                 }
             },
             "required": ["file_path"]
@@ -218,220 +438,268 @@ ALLOWED_FUNCTIONS: Dict[str, Dict[str, Any]] = {
     }
 }
 
-# Mapping of function names to actual Python functions
-AVAILABLE_FUNCTIONS: Dict[str, Any] = {
-    "list_directory": list_directory,
-    "print_working_directory": print_working_directory,
-    "list_processes": list_processes,
-    "display_file_contents": display_file_contents,
+# Mapping of function names to callables that unpack the model's arguments
+TOOL_DISPATCH: Dict[str, Callable[[Dict[str, Any]], str]] = {
+    "list_directory": lambda args: list_directory(args['path'], args.get('options', [])),
+    "print_working_directory": lambda args: print_working_directory(),
+    "list_processes": lambda args: list_processes(args.get('options', [])),
+    "display_file_contents": lambda args: display_file_contents(args['file_path']),
 }
 
-# Async Function to Interact with the Model
+# Tool definitions passed to the model, in Ollama's tool format; built once
+TOOLS = tuple({"type": "function", "function": spec} for spec in ALLOWED_FUNCTIONS.values())
 
-async def run(model: str, error_details: Dict[str, Any]):
-    logging.debug("Starting interaction with the Ollama model")
-    client = ollama.AsyncClient()
+# How long Ollama keeps the model, and the prompt prefix in its KV cache, loaded after a call
+KEEP_ALIVE = '30m'
+
+# System prompt for shell debugging
+SYSTEM_PROMPT = {
+    'role': 'system',
+    'content': (
+        "You are a shell debugger. Analyze the following failed shell command and provide a corrected command. "
+        "Only respond with the corrected shell command, or by using a tool provided. You may not ask clarifying questions. "
+        "You are expected to use the provided tools to answer the question."
+    )
+}
 
-    # Define the system prompt for shell debugging
-    system_prompt = {
-        'role': 'system',
+# Six multi-turn few-shot examples, shared by every run
+FEW_SHOT_EXAMPLES = (
+    # Example 1
+    {
+        'role': 'user',
         'content': (
-            "You are a shell debugger. Analyze the following failed shell command and provide a corrected command. "
-            "Only respond with the corrected shell command, or by using a tool provided. You may not ask clarifying questions. "
-            "You are expected to use the provided tools to answer the question."
+            "```sh\ncd /nonexistent_dir\n```\n"
+            "Error Output:\n```\nbash: cd: /nonexistent_dir: No such file or directory\n```"
         )
-    }
-
-    # Define six multi-turn few-shot examples
-    few_shot_examples = [
-        # Example 1
-        {
-            'role': 'user',
-            'content': (
-                "```sh\ncd /nonexistent_dir\n```\n"
-                "Error Output:\n```\nbash: cd: /nonexistent_dir: No such file or directory\n```"
-            )
-        },
-        {
-            'role': 'assistant',
-            'content': "",
-            'tool_calls': [
-                {
-                    'function': {
-                        'name': 'list_directory',
-                        'arguments': {
-                            'path': '/',
-                            'options': ['-la']
-                        }
+    },
+    {
+        'role': 'assistant',
+        'content': "",
+        'tool_calls': [
+            {
+                'function': {
+                    'name': 'list_directory',
+                    'arguments': {
+                        'path': '/',
+                        'options': ['-la']
                     }
                 }
-            ]
-        },
-        {
-            'role': 'tool',
-            'content': "drwxr-xr-x  5 root root  4096 Apr 10 10:00 existing_dir\n..."
-        },
-        {
-            'role': 'assistant',
-            'content': "cd /existing_dir"
-        },
-
-        # Example 2
-        {
-            'role': 'user',
-            'content': (
-                "```sh\ngrep 'pattern'\n```\n"
-                "Error Output:\n```\ngrep: missing file operand\nTry 'grep --help' for more information.\n```"
-            )
-        },
-        {
-            'role': 'assistant',
-            'content': "",
-            'tool_calls': [
-                {
-                    'function': {
-                        'name': 'list_directory',
-                        'arguments': {
-                            'path': '.',
-                            'options': ['-la']
-                        }
+            }
+        ]
+    },
+    {
+        'role': 'tool',
+        'content': "drwxr-xr-x  5 root root  4096 Apr 10 10:00 existing_dir\n..."
+    },
+    {
+        'role': 'assistant',
+        'content': "cd /existing_dir"
+    },
+
+    # Example 2
+    {
+        'role': 'user',
+        'content': (
+            "```sh\ngrep 'pattern'\n```\n"
+            "Error Output:\n```\ngrep: missing file operand\nTry 'grep --help' for more information.\n```"
+        )
+    },
+    {
+        'role': 'assistant',
+        'content': "",
+        'tool_calls': [
+            {
+                'function': {
+                    'name': 'list_directory',
+                    'arguments': {
+                        'path': '.',
+                        'options': ['-la']
                     }
                 }
-            ]
-        },
-        {
-            'role': 'tool',
-            'content': "file1.txt\nfile2.log\nscript.sh\n"
-        },
-        {
-            'role': 'assistant',
-            'content': "grep 'pattern' file1.txt"
-        },
-
-        # Example 3
-        {
-            'role': 'user',
-            'content': (
-                "```sh\ncat /etc/hostsh\n```\n"
-                "Error Output:\n```\nbash: cat: /etc/hostsh: No such file or directory\n```"
-            )
-        },
-        {
-            'role': 'assistant',
-            'content': "",
-            'tool_calls': [
-                {
-                    'function': {
-                        'name': 'list_directory',
-                        'arguments': {
-                            'path': '/etc',
-                            'options': []
-                        }
+            }
+        ]
+    },
+    {
+        'role': 'tool',
+        'content': "file1.txt\nfile2.log\nscript.sh\n"
+    },
+    {
+        'role': 'assistant',
+        'content': "grep 'pattern' file1.txt"
+    },
+
+    # Example 3
+    {
+        'role': 'user',
+        'content': (
+            "```sh\ncat /etc/hostsh\n```\n"
+            "Error Output:\n```\nbash: cat: /etc/hostsh: No such file or directory\n```"
+        )
+    },
+    {
+        'role': 'assistant',
+        'content': "",
+        'tool_calls': [
+            {
+                'function': {
+                    'name': 'list_directory',
+                    'arguments': {
+                        'path': '/etc',
+                        'options': []
                     }
                 }
-            ]
-        },
-        {
-            'role': 'tool',
-            'content': "hosts\nhostname\nresolv.conf\n"
-        },
-        {
-            'role': 'assistant',
-            'content': "cat /etc/hosts"
-        },
-
-        # Example 4
-        {
-            'role': 'user',
-            'content': (
-                "```sh\npython script.py\n```\n"
-                "Error Output:\n```\npython: command not found\n```"
-            )
-        },
-        {
-            'role': 'assistant',
-            'content': "",
-            'tool_calls': [
-                {
-                    'function': {
-                        'name': 'list_processes',
-                        'arguments': {
-                            'options': ['aux']
-                        }
+            }
+        ]
+    },
+    {
+        'role': 'tool',
+        'content': "hosts\nhostname\nresolv.conf\n"
+    },
+    {
+        'role': 'assistant',
+        'content': "cat /etc/hosts"
+    },
+
+    # Example 4
+    {
+        'role': 'user',
+        'content': (
+            "```sh\npython script.py\n```\n"
+            "Error Output:\n```\npython: command not found\n```"
+        )
+    },
+    {
+        'role': 'assistant',
+        'content': "",
+        'tool_calls': [
+            {
+                'function': {
+                    'name': 'list_processes',
+                    'arguments': {
+                        'options': ['aux']
                     }
                 }
-            ]
-        },
-        {
-            'role': 'tool',
-            'content': "USER       PID %CPU %MEM    VSZ   RSS TTY      STAT START   TIME COMMAND\n..."
-        },
-        {
-            'role': 'assistant',
-            'content': "python3 script.py"
-        },
-
-        # Example 5
-        {
-            'role': 'user',
-            'content': (
-                "```sh\nmkdir new_folder\n```\n"
-                "Error Output:\n```\nmkdir: cannot create directory 'new_folder': Permission denied\n```"
-            )
-        },
-        {
-            'role': 'assistant',
-            'content': "",
-            'tool_calls': [
-                {
-                    'function': {
-                        'name': 'print_working_directory',
-                        'arguments': {}
-                    }
+            }
+        ]
+    },
+    {
+        'role': 'tool',
+        'content': "USER       PID %CPU %MEM    VSZ   RSS TTY      STAT START   TIME COMMAND\n..."
+    },
+    {
+        'role': 'assistant',
+        'content': "python3 script.py"
+    },
+
+    # Example 5
+    {
+        'role': 'user',
+        'content': (
+            "```sh\nmkdir new_folder\n```\n"
+            "Error Output:\n```\nmkdir: cannot create directory 'new_folder': Permission denied\n```"
+        )
+    },
+    {
+        'role': 'assistant',
+        'content': "",
+        'tool_calls': [
+            {
+                'function': {
+                    'name': 'print_working_directory',
+                    'arguments': {}
                 }
-            ]
-        },
-        {
-            'role': 'tool',
-            'content': "/home/user/projects"
-        },
-        {
-            'role': 'assistant',
-            'content': "sudo mkdir new_folder"
-        },
-
-        # Example 6
-        {
-            'role': 'user',
-            'content': (
-                "```sh\nrm *.txt\n```\n"
-                "Error Output:\n```\nrm: missing operand after '*.txt'\nTry 'rm --help' for more information.\n```"
-            )
-        },
-        {
-            'role': 'assistant',
-            'content': "",
-            'tool_calls': [
-                {
-                    'function': {
-                        'name': 'list_directory',
-                        'arguments': {
-                            'path': '.',
-                            'options': ['-la']
-                        }
+            }
+        ]
+    },
+    {
+        'role': 'tool',
+        'content': "/home/user/projects"
+    },
+    {
+        'role': 'assistant',
+        'content': "sudo mkdir new_folder"
+    },
+
+    # Example 6
+    {
+        'role': 'user',
+        'content': (
+            "```sh\nrm *.txt\n```\n"
+            "Error Output:\n```\nrm: missing operand after '*.txt'\nTry 'rm --help' for more information.\n```"
+        )
+    },
+    {
+        'role': 'assistant',
+        'content': "",
+        'tool_calls': [
+            {
+                'function': {
+                    'name': 'list_directory',
+                    'arguments': {
+                        'path': '.',
+                        'options': ['-la']
                     }
                 }
-            ]
-        },
-        {
-            'role': 'tool',
-            'content': "file1.txt\nfile2.txt\nREADME.md\n"
-        },
-        {
-            'role': 'assistant',
-            'content': "rm *.txt"
-        },
+            }
+        ]
+    },
+    {
+        'role': 'tool',
+        'content': "file1.txt\nfile2.txt\nREADME.md\n"
+    },
+    {
+        'role': 'assistant',
+        'content': "rm *.txt"
+    },
+)
+
+def call_tool(tool: Dict[str, Any]) -> str:
+    """
+    Executes a single tool call requested by the model and returns its output.
+    """
+    function_name = tool['function']['name']
+    function_args = tool['function']['arguments']
+    logger.debug("Processing tool call: %s with arguments: %s", function_name, function_args)
+
+    if function_name not in TOOL_DISPATCH:
+        logger.warning("Function '%s' is not allowed", function_name)
+        return f"Function '{function_name}' is not allowed."
+
+    missing = [
+        name for name in ALLOWED_FUNCTIONS[function_name]['parameters'].get('required', [])
+        if name not in function_args
     ]
+    if missing:
+        logger.warning("Missing arguments for function '%s': %s", function_name, missing)
+        return f"Missing argument for function '{function_name}': {', '.join(missing)}."
+
+    try:
+        function_response = TOOL_DISPATCH[function_name](function_args)
+    except Exception as e:
+        logger.exception("Error executing function '%s'", function_name)
+        return f"Error executing function '{function_name}': {str(e)}"
+
+    logger.debug("Function '%s' executed successfully", function_name)
+    return function_response
+
+# Async Function to Interact with the Model
+
+# Shared client, so that both chat calls reuse its connection pool
+ollama_client = None
+
+def get_client() -> ollama.AsyncClient:
+    """
+    Returns the shared client. Its httpx connection pool keeps the connection
+    alive between calls and already asks for gzip-encoded responses.
+    """
+    global ollama_client
+    if ollama_client is None:
+        ollama_client = ollama.AsyncClient()
+    return ollama_client
+
+async def run(model: str, error_details: Dict[str, Any]):
+    logger.debug("Starting interaction with the Ollama model")
+    client = get_client()
 
     # Construct the user message as per the interaction pattern
     user_message = {
@@ -442,129 +710,111 @@ async def run(model: str, error_details: Dict[str, Any]):
         )
     }
 
-    # Initialize conversation with system prompt and few-shot examples
-    messages = [system_prompt] + few_shot_examples + [user_message]
+    # Initialize conversation with system prompt and few-shot examples. Both calls
+    # send this same prefix, so Ollama can reuse its cached prompt evaluation.
+    messages = [SYSTEM_PROMPT, *FEW_SHOT_EXAMPLES, user_message]
 
-    logging.debug("Conversation initialized with system prompt, few-shot examples, and user message")
+    logger.debug("Conversation initialized with system prompt, few-shot examples, and user message")
 
-    # First API call: Send the messages and function descriptions to the model
+    # First API call: Send the messages and function descriptions to the model.
+    # It is not streamed: older Ollama servers only return tool calls on
+    # non-streaming requests, and text sent ahead of a tool call must not be
+    # printed as the answer. No second call is needed when no tool is used.
     try:
-        logging.debug("Sending first API call to the model with messages and tools")
+        logger.debug("Sending first API call to the model with messages and tools")
         response = await client.chat(
             model=model,
             messages=messages,
-            tools=list(ALLOWED_FUNCTIONS.values()),
+            tools=TOOLS,
+            keep_alive=KEEP_ALIVE,
         )
-        logging.debug("Received response from the model")
+        logger.debug("Received response from the model")
     except Exception as e:
-        logging.exception("Error during the first API call to the model")
+        logger.exception("Error during the first API call to the model")
         print(f"Error communicating with the model: {str(e)}", file=sys.stderr)
         return
 
-    # Add the model's response to the conversation history
-    messages.append(response['message'])
-
     # Check if the model decided to use any provided function
-    if not response['message'].get('tool_calls'):
-        logging.debug("The model didn't use any function")
+    tool_calls = response['message'].get('tool_calls')
+    if not tool_calls:
+        logger.debug("The model didn't use any function")
         print(response['message']['content'])
         return
 
-    # Process function calls made by the model
-    if response['message'].get('tool_calls'):
-        for tool in response['message']['tool_calls']:
-            function_name = tool['function']['name']
-            function_args = tool['function']['arguments']
-            logging.debug(f"Processing tool call: {function_name} with arguments: {function_args}")
-
-            if function_name in AVAILABLE_FUNCTIONS:
-                function_to_call = AVAILABLE_FUNCTIONS[function_name]
-                try:
-                    if function_name == "list_directory":
-                        path = function_args['path']
-                        options = function_args.get('options', [])
-                        logging.debug(f"Calling list_directory with path: {path}, options: {options}")
-                        function_response = function_to_call(path, options)
-                    elif function_name == "print_working_directory":
-                        logging.debug("Calling print_working_directory")
-                        function_response = function_to_call()
-                    elif function_name == "list_processes":
-                        options = function_args.get('options', [])
-                        logging.debug(f"Calling list_processes with options: {options}")
-                        function_response = function_to_call(options)
-                    elif function_name == "display_file_contents":
-                        file_path = function_args['file_path']
-                        logging.debug(f"Calling display_file_contents with file_path: {file_path}")
-                        function_response = function_to_call(file_path)
-                    else:
-                        logging.warning(f"Function '{function_name}' is not implemented")
-                        function_response = f"Function '{function_name}' is not implemented."
-                except Exception as e:
-                    logging.exception(f"Error executing function '{function_name}'")
-                    function_response = f"Error executing function '{function_name}': {str(e)}"
-
-                # Add function response to the conversation
-                messages.append(
-                    {
-                        'role': 'tool',
-                        'content': function_response,
-                    }
-                )
-                logging.debug(f"Function '{function_name}' executed successfully")
-            else:
-                logging.warning(f"Function '{function_name}' is not allowed")
-                function_response = f"Function '{function_name}' is not allowed."
-                messages.append(
-                    {
-                        'role': 'tool',
-                        'content': function_response,
-                    }
-                )
+    # Add the model's response to the conversation history
+    response_message = {
+        'role': 'assistant',
+        'content': response['message'].get('content', ''),
+        'tool_calls': tool_calls,
+    }
+    messages.append(response_message)
+
+    # Process function calls made by the model. The tools block on
+    # subprocesses and file I/O, so they run concurrently in worker threads.
+    loop = asyncio.get_running_loop()
+    function_responses = await asyncio.gather(
+        *(loop.run_in_executor(None, call_tool, tool) for tool in tool_calls)
+    )
+
+    # Add function responses to the conversation, in the order they were requested
+    for function_response in function_responses:
+        messages.append(
+            {
+                'role': 'tool',
+                'content': function_response,
+            }
+        )
 
     # Second API call: Get final response from the model
     try:
-        logging.debug("Sending second API call to the model with updated messages")
-        final_response = await client.chat(model=model, messages=messages)
-        logging.debug("Received final response from the model")
+        logger.debug("Sending second API call to the model with updated messages")
+        final_response = await client.chat(model=model, messages=messages, keep_alive=KEEP_ALIVE)
+        logger.debug("Received final response from the model")
         print(final_response['message']['content'])
     except Exception as e:
-        logging.exception("Error during the second API call to the model")
+        logger.exception("Error during the second API call to the model")
         print(f"Error communicating with the model: {str(e)}", file=sys.stderr)
 
 # Main Execution Flow
 
 def main():
-    logging.debug("Starting main execution flow")
+    logger.debug("Starting main execution flow")
 
     # Check if a JSON file path is provided
     if len(sys.argv) != 2:
-        logging.error("Usage: python ollama_debugger.py <error_details_json_file>")
+        logger.error("Usage: python ollama_debugger.py <error_details_json_file>")
         print("Usage: python ollama_debugger.py <error_details_json_file>")
         sys.exit(1)
 
     # Load error details from the provided JSON file
     error_details_file = sys.argv[1]
-    if not os.path.exists(error_details_file):
-        logging.error(f"Error details file not found: {error_details_file}")
+    try:
+        with open(error_details_file, 'rb') as f:
+            error_details = loads_json(f.read())
+        logger.debug("Loaded error details: %s", list(error_details))
+    except FileNotFoundError:
+        logger.error("Error details file not found: %s", error_details_file)
         print(f"Error details file not found: {error_details_file}", file=sys.stderr)
         sys.exit(1)
-
-    try:
-        with open(error_details_file, 'r') as f:
-            file_contents = f.read()
-            error_details = json.loads(file_contents)
-        logging.debug(f"Loaded error details: {error_details}")
     except json.JSONDecodeError as e:
-        logging.exception(f"JSON decoding failed for file: {error_details_file}")
+        logger.exception("JSON decoding failed for file: %s", error_details_file)
         print(f"JSON decoding failed: {str(e)}", file=sys.stderr)
         sys.exit(1)
     except Exception as e:
-        logging.exception(f"Error reading error details file: {error_details_file}")
+        logger.exception("Error reading error details file: %s", error_details_file)
         print(f"Error reading error details file: {str(e)}", file=sys.stderr)
         sys.exit(1)
 
     # Run the async function to interact with the model
-    asyncio.run(run('llama3.1:8b', error_details))
+    # Prefer uvloop's loop, without going through the deprecated event loop policy API
+    coroutine = run('llama3.1:8b', error_details)
+    if uvloop is not None and hasattr(uvloop, 'run'):
+        uvloop.run(coroutine)
+    elif uvloop is not None and hasattr(asyncio, 'Runner'):
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            runner.run(coroutine)
+    else:
+        asyncio.run(coroutine)
 
 # Run the main function
 if __name__ == "__main__":
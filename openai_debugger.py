@@ -1,20 +1,36 @@
 #!/usr/bin/env python3
-import openai
 import logging
 
 import subprocess
 import shlex
+import socket
 import json
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import shutil
 import time
-import fcntl
-from openai import OpenAI
-from openai import AssistantEventHandler
+import functools
+import grp
+import pwd
+import stat
 from typing_extensions import override
-client = OpenAI()
+
+# orjson is optional; it serializes the error details several times faster than json
+try:
+    import orjson
+
+    def dumps_pretty(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+
+    def dumps_compact(obj):
+        return orjson.dumps(obj)
+except ImportError:
+    def dumps_pretty(obj):
+        return json.dumps(obj, indent=2).encode()
+
+    def dumps_compact(obj):
+        return json.dumps(obj).encode()
 
 # ==========================
 # Configuration and Setup
@@ -22,13 +38,29 @@ client = OpenAI()
 
 # Configuration file path
 CONFIG_FILE = os.path.expanduser('~/.openai_debugger_config.json')
+# Per shell session file holding the thread ID reused across failed commands.
+# The plugin sets LLM_DEBUGGER_THREAD_FILE and removes the file when the shell exits.
+THREAD_FILE = os.getenv('LLM_DEBUGGER_THREAD_FILE') or \
+    os.path.expanduser(f'~/.openai_debugger_thread_{os.getppid()}')
+# Messages of the thread a run reads: the new failure and the two exchanges
+# before it. Older messages stay in the thread but are not sent as input.
+THREAD_CONTEXT_MESSAGES = 5
 LOG_FILE = os.path.expanduser('~/.openai_debugger.log')
-logging.basicConfig(
-    filename=LOG_FILE,
-    filemode='w',
-    level=logging.DEBUG,  # Change to logging.INFO or logging.ERROR to reduce verbosity
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# Set LLM_DEBUGGER_LOG=DEBUG for verbose logging
+LOG_LEVEL = os.getenv('LLM_DEBUGGER_LOG', 'WARNING').upper()
+
+def configure_logging():
+    """
+    Configures logging to append to LOG_FILE.
+    Called only once a command has failed, so successful commands never touch the log.
+    """
+    logging.basicConfig(
+        filename=LOG_FILE,
+        filemode='a',
+        level=getattr(logging, LOG_LEVEL, logging.WARNING),
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
 def load_config():
     """
     Loads the configuration from the CONFIG_FILE.
@@ -61,8 +93,14 @@ if not OPENAI_API_KEY:
     print("Error: openai_DEBUGGER_OPENAI_API_KEY is not set.", file=sys.stderr)
     sys.exit(1)
 
-# Initialize OpenAI client
-openai.api_key = OPENAI_API_KEY
+def create_client():
+    """
+    Creates the OpenAI client.
+    The openai package is imported here rather than at module level because
+    importing it is expensive and only needed once a command has failed.
+    """
+    from openai import OpenAI
+    return OpenAI(api_key=OPENAI_API_KEY)
 
 # ==========================
 # Define Allowed Functions
@@ -132,11 +170,14 @@ ALLOWED_FUNCTIONS = {
     }
 }
 
+# Tool definitions passed to the assistant, built from ALLOWED_FUNCTIONS
+TOOLS = [{"type": "function", "function": spec} for spec in ALLOWED_FUNCTIONS.values()]
+
 # ==========================
 # Helper Functions
 # ==========================
 
-def create_assistant():
+def create_assistant(client):
     """
     Creates an assistant with predefined tools and instructions.
     Returns the assistant ID.
@@ -149,81 +190,7 @@ def create_assistant():
                 "Only suggest the exact shell command to execute in a shell that may solve their problem, no extraneous text."
                 "Use the provided functions to gather additional information when necessary."
             ),
-            tools=[
-                {
-                    "type": "function",  # Specify the type of tool as 'function'
-                    "function": {
-                        "name": "list_directory",
-                        "description": "List files and directories in a specified path.",
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "path": {
-                                    "type": "string",
-                                    "description": "The directory path to list."
-                                },
-                                "options": {
-                                    "type": "array",
-                                    "items": {
-                                        "type": "string",
-                                        "enum": ["-la", "--help"]
-                                    },
-                                    "description": "Options to modify the behavior of the ls command."
-                                }
-                            },
-                            "required": ["path"]
-                        }
-                    }
-                },
-                {
-                    "type": "function",  # Specify the type of tool as 'function'
-                    "function": {
-                        "name": "print_working_directory",
-                        "description": "Print the current working directory.",
-                        "parameters": {
-                            "type": "object",
-                            "properties": {}
-                        }
-                    }
-                },
-                {
-                    "type": "function",  # Specify the type of tool as 'function'
-                    "function": {
-                        "name": "list_processes",
-                        "description": "List currently running processes.",
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "options": {
-                                    "type": "array",
-                                    "items": {
-                                        "type": "string",
-                                        "enum": ["aux", "--help"]
-                                    },
-                                    "description": "Options to modify the behavior of the ps command."
-                                }
-                            }
-                        }
-                    }
-                },
-                {
-                    "type": "function",  # Specify the type of tool as 'function'
-                    "function": {
-                        "name": "display_file_contents",
-                        "description": "Display the contents of a specified file.",
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "file_path": {
-                                    "type": "string",
-                                    "description": "The path to the file to display."
-                                }
-                            },
-                            "required": ["file_path"]
-                        }
-                    }
-                }
-            ],
+            tools=TOOLS,
             model="gpt-4o"  # Specify the model you're using
         )
 
@@ -233,20 +200,20 @@ def create_assistant():
         print(f"Failed to create assistant: {e}", file=sys.stderr)
         sys.exit(1)
 
-def create_thread(error_details):
+def create_thread(client, error_details):
     """
     Creates a new thread for the conversation.
     Returns the thread ID.
     """
     try:
-        thread = thread = client.beta.threads.create(
+        thread = client.beta.threads.create(
             messages=[
                 {
                 "role": "user",
                 "content": [
                     {
                     "type": "text",
-                    "text": json.dumps(error_details)
+                    "text": dumps_compact(error_details).decode()
                     },
                 ],
                 }
@@ -254,11 +221,63 @@ def create_thread(error_details):
         )
 
         logging.debug(f"Thread created with ID: {thread.id}")
-        return thread
+        return thread.id
     except Exception as e:
         print(f"Failed to create thread: {e}", file=sys.stderr)
         sys.exit(1)
 
+def load_thread_id():
+    """
+    Returns the thread ID saved for this shell session, or None.
+    """
+    try:
+        with open(THREAD_FILE, 'r') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.error(f"Failed to read thread file: {e}")
+        return None
+
+def save_thread_id(thread_id):
+    """
+    Saves the thread ID for reuse by later failures in this shell session.
+    """
+    try:
+        with open(THREAD_FILE, 'w') as f:
+            f.write(thread_id)
+    except Exception as e:
+        logging.error(f"Failed to write thread file: {e}")
+
+def add_error_message(client, thread_id, error_details):
+    """
+    Adds the error details to an existing thread.
+    Returns True on success, False if the thread cannot be used.
+    """
+    try:
+        client.beta.threads.messages.create(
+            thread_id=thread_id,
+            role="user",
+            content=dumps_compact(error_details).decode()
+        )
+        logging.debug(f"Reusing thread with ID: {thread_id}")
+        return True
+    except Exception as e:
+        logging.error(f"Failed to add message to thread {thread_id}: {e}")
+        return False
+
+def get_or_create_thread(client, error_details):
+    """
+    Posts the error details to this session's thread, creating the thread if needed.
+    Returns the thread ID.
+    """
+    thread_id = load_thread_id()
+    if thread_id and add_error_message(client, thread_id, error_details):
+        return thread_id
+    thread_id = create_thread(client, error_details)
+    save_thread_id(thread_id)
+    return thread_id
+
 def execute_shell_command(command, env=os.environ):
     """
     Executes a shell command and captures its output and exit status.
@@ -277,24 +296,105 @@ def execute_shell_command(command, env=os.environ):
     except Exception as e:
         return '', str(e), 1
 
+def execute_argv(argv, env=os.environ):
+    """
+    Executes a command given as an argument list, without a shell, and
+    captures its combined stdout and stderr and its exit status.
+    """
+    try:
+        result = subprocess.run(
+            argv,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,  # Merge the streams in the pipe itself
+            text=True,
+            errors='replace',
+            env=env
+        )
+        return result.stdout, result.returncode
+    except Exception as e:
+        return str(e), 1
+
+# Environment variables worth sending to the assistant; everything else is dropped
+ENVIRONMENT_ALLOWLIST = frozenset({
+    'PATH', 'SHELL', 'HOME', 'LANG', 'PWD', 'USER', 'TERM', 'VIRTUAL_ENV', 'CONDA_PREFIX'
+})
+
+# Collects the system and binary details in a single /bin/sh invocation.
+# Sections are separated by ERROR_DETAILS_SEPARATOR; the binary name is $1.
+ERROR_DETAILS_SEPARATOR = '__SEP__\n'
+ERROR_DETAILS_SCRIPT = """
+uname -a
+echo __SEP__
+if [ -f /etc/os-release ]; then cat /etc/os-release; else echo "OS release information not available"; fi
+echo __SEP__
+if which "$1" >/dev/null 2>&1; then
+    which "$1"
+    echo __SEP__
+    "$1" --version 2>&1
+else
+    echo "Command not found in PATH"
+    echo __SEP__
+    echo "Version information not available"
+fi
+"""
+
+def gather_system_details(binary):
+    """
+    Runs ERROR_DETAILS_SCRIPT once and returns its four sections:
+    system information, OS release, binary location and binary version.
+    """
+    result = subprocess.run(
+        ['/bin/sh', '-c', ERROR_DETAILS_SCRIPT, 'sh', binary],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True
+    )
+    sections = result.stdout.split(ERROR_DETAILS_SEPARATOR, 3)
+    sections += [''] * (4 - len(sections))
+    return [section.rstrip('\n') for section in sections]
+
+def truncate_output(text, head=4096, tail=4096):
+    """
+    Keeps the beginning and end of long text so the assistant input stays bounded.
+    """
+    if len(text) <= head + tail:
+        return text
+    return text[:head] + f"\n...[{len(text) - head - tail} characters truncated]...\n" + text[-tail:]
+
+def command_binary(command):
+    """
+    Returns the executable name of a command line.
+    Falls back to plain whitespace splitting when the command cannot be
+    tokenized, for example because of an unbalanced quote.
+    """
+    try:
+        return shlex.split(command)[0]
+    except (ValueError, IndexError):
+        parts = command.split()
+        return parts[0] if parts else ''
+
 def gather_error_details(command, exit_status, stdout, stderr):
     """
     Gathers detailed error information, including system and environment details.
     """
+    system_information, os_release, command_binary_details, command_version = \
+        gather_system_details(command_binary(command))
     details = {
         "timestamp": datetime.now().isoformat(),
         "command": command,
         "exit_status": exit_status,
-        "stdout": stdout,
-        "stderr": stderr,
+        "stdout": truncate_output(stdout),
+        "stderr": truncate_output(stderr),
         "working_directory": os.getcwd(),
         "shell": os.getenv('SHELL', ''),
-        "PATH": os.getenv('PATH', ''),
-        "system_information": subprocess.getoutput('uname -a'),
-        "os_release": subprocess.getoutput('cat /etc/os-release') if os.path.exists('/etc/os-release') else "OS release information not available",
-        "command_binary_details": subprocess.getoutput(f'which {shlex.split(command)[0]}') if shutil.which(shlex.split(command)[0]) else "Command not found in PATH",
-        "command_version": subprocess.getoutput(f'{shlex.split(command)[0]} --version') if shutil.which(shlex.split(command)[0]) else "Version information not available",
-        "environment_variables": dict(os.environ)
+        "system_information": system_information,
+        "os_release": truncate_output(os_release),
+        "command_binary_details": command_binary_details,
+        "command_version": truncate_output(command_version),
+        "environment_variables": {
+            k: truncate_output(os.environ[k]) for k in ENVIRONMENT_ALLOWLIST if k in os.environ
+        }
     }
     return details
 
@@ -304,336 +404,353 @@ def log_error(details):
     """
     log_file = os.path.expanduser('~/.openai_debugger_last_error.log')
     try:
-        with open(log_file, 'w') as f:
-            json.dump(details, f, indent=4)
+        # Serialize first, then write the whole payload with a single unbuffered write
+        payload = dumps_pretty(details)
+        fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, payload)
+        finally:
+            os.close(fd)
     except Exception as e:
         print(f"Failed to write to log file: {e}", file=sys.stderr)
 
-def handle_function_call(function_call):
+def run_tool_command(argv):
     """
-    Executes the requested function (tool) and returns its output.
+    Runs a tool command and returns its result as a dictionary.
     """
-    logging.debug(f"function_call details {function_call}")
-    function_name = getattr(function_call, 'name', None)
-    arguments = json.loads(getattr(function_call, 'arguments', '{}'))
-
-    if function_name not in ALLOWED_FUNCTIONS:
-        return {"error": f"Function '{function_name}' is not allowed."}
-
-    # Prepare the command based on the function
-    if function_name == "list_directory":
-        path = arguments.get('path', '.')
-        options = ' '.join(arguments.get('options', []))
-        command = f"ls {options} {shlex.quote(path)}"
-    elif function_name == "print_working_directory":
-        command = "pwd"
-    elif function_name == "list_processes":
-        options = ' '.join(arguments.get('options', []))
-        command = f"ps {options}"
-    elif function_name == "display_file_contents":
-        file_path = arguments.get('file_path')
-        if not file_path:
-            return {"error": "Missing 'file_path' argument."}
-        command = f"cat {shlex.quote(file_path)}"
-    else:
-        return {"error": f"Function '{function_name}' is not implemented."}
-
-    stdout, stderr, exit_status = execute_shell_command(command)
-
+    output, exit_status = execute_argv(argv)
     return {
-        "stdout": stdout,
-        "stderr": stderr,
+        "output": output,
         "exit_status": exit_status
     }
 
-def submit_tool_outputs(run, thread_id, tool_outputs):
+def format_long_listing(name, st, target=None):
     """
-    Submits the tool outputs back to the assistant to continue the run.
+    Formats a single entry the way `ls -la` does.
     """
-    # Use the submit_tool_outputs_stream helper
-    with client.beta.threads.runs.submit_tool_outputs_stream(
-        thread_id=thread_id,
-        run_id=run.id,
-        tool_outputs=tool_outputs,
-        event_handler=StreamingEventHandler(),
-    ) as stream:
-        stream.until_done()
-
-def process_run(run, thread_id):
+    try:
+        owner = pwd.getpwuid(st.st_uid).pw_name
+    except KeyError:
+        owner = str(st.st_uid)
+    try:
+        group = grp.getgrgid(st.st_gid).gr_name
+    except KeyError:
+        group = str(st.st_gid)
+    modified = time.strftime('%b %d %H:%M', time.localtime(st.st_mtime))
+    line = f"{stat.filemode(st.st_mode)} {st.st_nlink:>3} {owner} {group} {st.st_size:>8} {modified} {name}"
+    if target is not None:
+        line += f" -> {target}"
+    return line
+
+def list_directory(arguments):
     """
-    Processes a run that requires action (function calls).
-    Executes the requested functions and submits their outputs.
+    Lists a directory with os.scandir, mimicking `ls` and `ls -la`.
     """
-    if run.status == "requires_action" and run.required_action.type == "submit_tool_outputs":
-        thread_id = thread_id
-        tool_calls = run.required_action.submit_tool_outputs.tool_calls
-
-        tool_outputs = []
+    path = arguments.get('path', '.')
+    options = arguments.get('options', [])
+    if '--help' in options:
+        return run_tool_command(['ls', '--help'])
+    long_format = '-la' in options
+    try:
+        if not os.path.isdir(path):
+            st = os.lstat(path)
+            line = format_long_listing(path, st) if long_format else path
+            return {"output": line + '\n', "exit_status": 0}
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        if not long_format:
+            lines = [entry.name for entry in entries if not entry.name.startswith('.')]
+        else:
+            lines = [
+                format_long_listing(name, os.lstat(os.path.join(path, name)))
+                for name in ('.', '..')
+            ]
+            for entry in entries:
+                st = entry.stat(follow_symlinks=False)
+                target = os.readlink(entry.path) if entry.is_symlink() else None
+                lines.append(format_long_listing(entry.name, st, target))
+    except OSError as e:
+        return {"output": f"ls: cannot access '{path}': {e.strerror}\n", "exit_status": 2}
+    return {"output": ''.join(line + '\n' for line in lines), "exit_status": 0}
+
+def print_working_directory(arguments):
+    return {"output": os.getcwd() + '\n', "exit_status": 0}
+
+def list_processes(arguments):
+    # ps has no cheap native equivalent, so it still runs as a subprocess
+    return run_tool_command(['ps', *arguments.get('options', [])])
+
+def display_file_contents(arguments):
+    file_path = arguments.get('file_path')
+    if not file_path:
+        return {"error": "Missing 'file_path' argument."}
+    try:
+        with open(file_path, 'r', errors='replace') as f:
+            contents = f.read()
+    except OSError as e:
+        return {"output": f"cat: {file_path}: {e.strerror}\n", "exit_status": 1}
+    return {"output": contents, "exit_status": 0}
+
+# Maps each allowed function to its implementation
+TOOL_HANDLERS = {
+    "list_directory": list_directory,
+    "print_working_directory": print_working_directory,
+    "list_processes": list_processes,
+    "display_file_contents": display_file_contents,
+}
 
-        for tool_call in tool_calls:
-            tool_call_id = tool_call.id
-            function_call = tool_call.function
+def handle_function_call(function_call):
+    """
+    Executes the requested function (tool) and returns its output.
+    """
+    logging.debug(f"function_call details {function_call}")
+    function_name = function_call.name
+    arguments = json.loads(function_call.arguments or '{}')
 
-            result = handle_function_call(function_call)
+    if function_name not in ALLOWED_FUNCTIONS:
+        return {"error": f"Function '{function_name}' is not allowed."}
 
-            if 'error' in result:
-                print(f"Error executing function {function_call.name}: {result['error']}", file=sys.stderr)
-                tool_output = f"Error: {result['error']}"
-            else:
-                # Combine stdout and stderr
-                tool_output = result['stdout'] + result['stderr']
+    handler = TOOL_HANDLERS.get(function_name)
+    if not handler:
+        return {"error": f"Function '{function_name}' is not implemented."}
+    return handler(arguments)
 
-            tool_outputs.append({
-                "tool_call_id": tool_call_id,
-                "output": tool_output
-            })
-        # Submit all tool outputs at once
-        submit_tool_outputs(run, thread_id, tool_outputs)
-    # else:
+# Unix socket the plugin listens on for suggestions. The plugin exports
+# LLM_DEBUGGER_SOCKET; the fallback matches its default for this shell.
+SOCKET_PATH = os.getenv('LLM_DEBUGGER_SOCKET') or f'/tmp/llm_debugger_{os.getppid()}.sock'
 
-FIFO_PATH = '/tmp/openai_debugger_fifo'
+# Connection to the plugin, opened once and shared by every writer
+suggestion_socket = None
 
-def create_fifo():
-    if not os.path.exists(FIFO_PATH):
-        os.mkfifo(FIFO_PATH)
+# Streamed text is buffered and written once either limit is reached
+SOCKET_FLUSH_SIZE = 512
+SOCKET_FLUSH_INTERVAL = 0.05
 
-def send_suggestion(suggestion):
-    logging.debug(f"send_suggestion: {suggestion}")
+def get_socket():
+    """
+    Returns the connection to the plugin's socket, connecting on first use.
+    """
+    global suggestion_socket
+    if suggestion_socket is None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(SOCKET_PATH)
+        except OSError:
+            sock.close()
+            raise
+        suggestion_socket = sock
+    return suggestion_socket
+
+def write_to_socket(data):
+    """
+    Sends a string to the plugin through the shared connection.
+    """
     try:
-        with open(FIFO_PATH, 'w') as fifo:
-            # Strip leading/trailing whitespace and newlines
-            suggestion = suggestion.strip()
-            fifo.write(suggestion + '\n')
-            fifo.write('EOF\n')
-            fifo.flush()
+        get_socket().sendall(data.encode())
     except Exception as e:
-        logging.error(f"Failed to write to FIFO: {e}")
-
+        logging.error(f"Failed to write to socket: {e}")
 
+def send_suggestion(suggestion):
+    logging.debug(f"send_suggestion: {suggestion}")
+    # Strip leading/trailing whitespace and newlines
+    write_to_socket(suggestion.strip() + '\nEOF\n')
 
 def send_command_result(stdout, stderr, exit_status):
-    with open(FIFO_PATH, 'w') as fifo:
-        fcntl.fcntl(fifo, fcntl.F_SETFL, os.O_NONBLOCK)
-        json.dump({
-            "type": "command_result",
-            "stdout": stdout,
-            "stderr": stderr,
-            "exit_status": exit_status
-        }, fifo)
-        fifo.write('\n')
-        fifo.flush()
-        
-class EventHandler(AssistantEventHandler):
-    def __init__(self):
-        super().__init__()
-
-    @override
-    def on_event(self, event):
-        # Handle various events
-        logging.debug(f"Event received: {event.event}")
-        if event.event == 'thread.run.requires_action':
-            run_id = event.data.id  # Retrieve the run ID from the event data
-            self.handle_requires_action(event.data, run_id)
-        if event.event == 'thread.message.completed':
-            self.handle_final_message(event)
-        # if event.event == 'thread.message.delta':
-        #     self.on_text_delta(event.data.delta, event.data)
-        else:
-            self.handle_general_event(event)
-            
-    def on_text_delta(self, delta, data):
-        handled = True
-        logging.debug(delta)
-        # if delta.content[0].type == 'text':
-        #     text_value = delta.content[0].text.value
-        # logging.debug(f"Text delta received: {text_value}")
-        # elif delta.content[0].type == 'command_result':
-        #     stdout = delta.command_result.stdout
-        #     stderr = delta.command_result.stderr
-        #     exit_status = delta.command_result.exit_status
-        # logging.debug(f"Command result received: stdout={stdout}, stderr={stderr}, exit_status={exit_status}")
-
-    def handle_requires_action(self, data, run_id):
-        tool_outputs = []
-        
-        for tool in data.required_action.submit_tool_outputs.tool_calls:
-            function_call = tool.function
-            result = handle_function_call(function_call)
-            
-            if 'error' in result:
-                tool_output = f"Error: {result['error']}"
-            else:
-                tool_output = result['stdout'] + result['stderr']
-            
-            tool_outputs.append({
-                "tool_call_id": tool.id,
-                "output": tool_output
-            })
-        logging.debug(f"handle_requires_action: {tool_outputs} {run_id}")
-        # Submit all tool_outputs at the same time
-        self.submit_tool_outputs(tool_outputs, run_id)
- 
-    def submit_tool_outputs(self, tool_outputs, run_id):
-        # Use the submit_tool_outputs_stream helper
-        with client.beta.threads.runs.submit_tool_outputs_stream(
-            thread_id=self.current_run.thread_id,
-            run_id=self.current_run.id,
-            tool_outputs=tool_outputs,
-            event_handler=StreamingEventHandler(),
-        ) as stream:
-            stream.until_done()
+    write_to_socket(json.dumps({
+        "type": "command_result",
+        "stdout": stdout,
+        "stderr": stderr,
+        "exit_status": exit_status
+    }) + '\n')
 
-    def handle_general_event(self, event):
-        handled = True
-        logging.debug(f"Handling event: {event.event}")
-        # Add any specific logic for general events if needed
-        
-    def handle_final_message(self, event):
-        handled = True    
-        # Extract the final message content
-        # final_message = event.data.content
-        # if final_message:
-        #     for content_block in final_message:
-        #         if content_block.type == 'text':
-        #             final_text = content_block.text.value
-        # logging.debug(f"Final suggested command: {final_text}")
-        
-class StreamingEventHandler(EventHandler):
-    def __init__(self):
-        super().__init__()
-        self.suggestion = ""
-        try:
-            self.fifo = open(FIFO_PATH, 'w')
-            fcntl.fcntl(self.fifo, fcntl.F_SETFL, os.O_NONBLOCK)
-        except Exception as e:
-            logging.error(f"Failed to open FIFO for writing: {e}")
-            
-    def __del__(self):
-        # Close the FIFO
-        try:
-            self.fifo.close()
-        except Exception as e:
-            logging.error(f"Failed to close FIFO: {e}")
-
-
-    @override
-    def on_text_created(self, text) -> None:
-        self.suggestion += text.value
-        # send_suggestion(self.suggestion)
-
-    @override
-    def on_text_delta(self, delta, data):
-        text_value = delta.value
-        self.suggestion += text_value
-        logging.debug(f"Text delta received: {text_value}")
-        # Write the delta to the FIFO
-        try:
-            self.fifo.write(text_value)
-            self.fifo.flush()
-        except Exception as e:
-            logging.error(f"Failed to write to FIFO: {e}")
-
-        
-    @override
-    def handle_general_event(self, event):
-        logging.debug(f"Handling event: {event.event}")
-        # Add any specific logic for general events if needed
-        done = True
-    
-    @override
-    def handle_final_message(self, event):
-        logging.debug(f"Final message received: {event}")
-        # Send 'EOF' to signal the end
-        try:
-            self.fifo.write('\nEOF\n')
-            self.fifo.flush()
-        except Exception as e:
-            logging.error(f"Failed to write EOF to FIFO: {e}")
-        
-        # # Extract the final message content
-        # final_message = event.data.content[0]
-        # if final_message:
-        #     for (type, text) in final_message:
-        #         logging.debug(f"content_block:{type}")
-        #         if type == 'text':
-        #             final_text = text.value
-        #             logging.debug(f"Final suggested command: {final_text}")
-        #             send_suggestion(final_text)
-        #             send_suggestion("EOF")  # Signal EOF to the Zsh script
-
-
-            
-def initiate_run(user_command, assistant_id, thread):
+@functools.lru_cache(maxsize=1)
+def load_event_handlers():
+    """
+    Defines the assistant event handlers and returns the StreamingEventHandler class.
+    The classes subclass openai.AssistantEventHandler, so they are only built once
+    the openai package is actually needed.
+    """
+    from openai import AssistantEventHandler
+
+    class EventHandler(AssistantEventHandler):
+        def __init__(self, client):
+            super().__init__()
+            self.client = client
+
+        @override
+        def on_event(self, event):
+            # Handle various events
+            event_type = event.event
+            logging.debug("Event received: %s", event_type)
+            if event_type == 'thread.run.requires_action':
+                run_id = event.data.id  # Retrieve the run ID from the event data
+                self.handle_requires_action(event.data, run_id)
+            if event_type == 'thread.message.completed':
+                self.handle_final_message(event)
+            # if event.event == 'thread.message.delta':
+            #     self.on_text_delta(event.data.delta, event.data)
+            else:
+                self.handle_general_event(event)
+
+        def on_text_delta(self, delta, data):
+            handled = True
+            logging.debug(delta)
+            # if delta.content[0].type == 'text':
+            #     text_value = delta.content[0].text.value
+            # logging.debug(f"Text delta received: {text_value}")
+            # elif delta.content[0].type == 'command_result':
+            #     stdout = delta.command_result.stdout
+            #     stderr = delta.command_result.stderr
+            #     exit_status = delta.command_result.exit_status
+            # logging.debug(f"Command result received: stdout={stdout}, stderr={stderr}, exit_status={exit_status}")
+
+        def handle_requires_action(self, data, run_id):
+            tool_outputs = []
+
+            for tool in data.required_action.submit_tool_outputs.tool_calls:
+                function_call = tool.function
+                result = handle_function_call(function_call)
+
+                if 'error' in result:
+                    tool_output = f"Error: {result['error']}"
+                else:
+                    tool_output = truncate_output(result['output'])
+
+                tool_outputs.append({
+                    "tool_call_id": tool.id,
+                    "output": tool_output
+                })
+            logging.debug(f"handle_requires_action: {tool_outputs} {run_id}")
+            # Submit all tool_outputs at the same time
+            self.submit_tool_outputs(tool_outputs, run_id)
+
+        def submit_tool_outputs(self, tool_outputs, run_id):
+            # Use the submit_tool_outputs_stream helper
+            with self.client.beta.threads.runs.submit_tool_outputs_stream(
+                thread_id=self.current_run.thread_id,
+                run_id=self.current_run.id,
+                tool_outputs=tool_outputs,
+                event_handler=StreamingEventHandler(self.client),
+            ) as stream:
+                stream.until_done()
+
+        def handle_general_event(self, event):
+            handled = True
+            logging.debug(f"Handling event: {event.event}")
+            # Add any specific logic for general events if needed
+
+        def handle_final_message(self, event):
+            handled = True    
+            # Extract the final message content
+            # final_message = event.data.content
+            # if final_message:
+            #     for content_block in final_message:
+            #         if content_block.type == 'text':
+            #             final_text = content_block.text.value
+            # logging.debug(f"Final suggested command: {final_text}")
+
+    class StreamingEventHandler(EventHandler):
+        def __init__(self, client):
+            super().__init__(client)
+            self.suggestion = ""
+            self.buffer = []
+            self.buffered_size = 0
+            self.last_flush = time.monotonic()
+
+        def flush_buffer(self, trailer=''):
+            """
+            Writes the buffered text, followed by the optional trailer, in a single write.
+            """
+            data = ''.join(self.buffer) + trailer
+            self.buffer.clear()
+            self.buffered_size = 0
+            self.last_flush = time.monotonic()
+            if data:
+                write_to_socket(data)
+
+        @override
+        def on_text_created(self, text) -> None:
+            self.suggestion += text.value
+            # send_suggestion(self.suggestion)
+
+        @override
+        def on_text_delta(self, delta, data):
+            text_value = delta.value or ''
+            self.suggestion += text_value
+            logging.debug("Text delta received: %s", text_value)
+            # Buffer the delta and send it to the plugin in batches
+            self.buffer.append(text_value)
+            self.buffered_size += len(text_value)
+            if (self.buffered_size >= SOCKET_FLUSH_SIZE
+                    or time.monotonic() - self.last_flush > SOCKET_FLUSH_INTERVAL):
+                self.flush_buffer()
+
+        @override
+        def on_end(self):
+            self.flush_buffer()
+
+        @override
+        def handle_general_event(self, event):
+            logging.debug(f"Handling event: {event.event}")
+            # Add any specific logic for general events if needed
+            done = True
+
+        @override
+        def handle_final_message(self, event):
+            logging.debug(f"Final suggestion: {self.suggestion}")
+            # Send the remaining text and 'EOF' to signal the end
+            self.flush_buffer('\nEOF\n')
+
+            # # Extract the final message content
+            # final_message = event.data.content[0]
+            # if final_message:
+            #     for (type, text) in final_message:
+            #         logging.debug(f"content_block:{type}")
+            #         if type == 'text':
+            #             final_text = text.value
+            #             logging.debug(f"Final suggested command: {final_text}")
+            #             send_suggestion(final_text)
+            #             send_suggestion("EOF")  # Signal EOF to the Zsh script
+
+    return StreamingEventHandler
+
+def initiate_run(client, user_command, assistant_id, thread_id):
     """
     Initiates a run with the assistant based on the user's command.
     Returns the run object.
     """
     try:
         with client.beta.threads.runs.stream(
-            thread_id=thread.id,
+            thread_id=thread_id,
             assistant_id=assistant_id,
             instructions=(
                 "You are a shell debugger. Analyze shell command errors and suggest a working command. "
                 "You are to only provide a suggested shell command-line, no other text, and no code blocks. "
                 "Use the provided functions to gather additional information when necessary."
             ),
-            event_handler=StreamingEventHandler(),
+            truncation_strategy={"type": "last_messages", "last_messages": THREAD_CONTEXT_MESSAGES},
+            event_handler=load_event_handlers()(client),
         )  as stream:
             stream.until_done()
     except Exception as e:
         print(f"Failed to initiate run: {e}", file=sys.stderr)
         sys.exit(1)
 
-def monitor_run(run, thread):
-    logging.debug(f"DEBUG: Starting to monitor run with ID: {run.id}")
-    thread_id = thread.id
-    
-    while True:
-        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-        if run.status == "requires_action":
-            process_run(run, thread_id)
-        elif run.status == "completed":
-            break
-        elif run.status in ["failed", "cancelled", "expired"]:
-            print(f"Run failed with status: {run.status}", file=sys.stderr)
-            break
-        time.sleep(1)
-
-    if run.status == "completed":
-        messages = client.beta.threads.messages.list(thread_id=thread_id)
-        assistant_reply = messages.data[0].content[0].text.value
-        logging.debug(f"\nFinal suggestion:{assistant_reply}")
-
-def create_assistant_if_not_exists(config):
-    """
-    # Creates an assistant if it does not exist in the config.
+def create_assistant_if_not_exists(client, config):
+    """
+    Creates an assistant if it does not exist in the config.
     Returns the assistant_id.
     """
     assistant_id = config.get('assistant_id')
     if assistant_id:
         return assistant_id
     # Create assistant
-    assistant_id = create_assistant()
+    assistant_id = create_assistant(client)
     # Update config
     config['assistant_id'] = assistant_id
     save_config(config)
     return assistant_id
 
-def create_thread_if_not_exists(config):
-    """
-    Creates a thread if it does not exist in the config.
-    Returns the thread_id.
-    """
-    # thread_id = config.get('thread_id')
-    # if thread_id:
-    #     return thread_id
-    # Create thread
-    thread_id = create_thread()
-    # Update config
-    config['thread_id'] = thread_id.id
-    save_config(config)
-    return thread_id
-
 # ==========================
 # Main Execution Flow
 # ==========================
@@ -641,38 +758,63 @@ def create_thread_if_not_exists(config):
 def main():
     if len(sys.argv) < 2:
         print("Usage: openai_debugger.py <command>", file=sys.stderr)
+        print("       openai_debugger.py --analyze <command> <exit_status> < output", file=sys.stderr)
         sys.exit(1)
 
-    # Load configuration
-    config = load_config()
-
-    # Reconstruct the command from arguments
-    user_command = ' '.join(sys.argv[1:])
+    if sys.argv[1] == '--analyze':
+        # The shell already ran the command; its combined output arrives on stdin
+        if len(sys.argv) != 4:
+            print("Usage: openai_debugger.py --analyze <command> <exit_status> < output", file=sys.stderr)
+            sys.exit(1)
+        user_command = sys.argv[2]
+        try:
+            exit_status = int(sys.argv[3])
+        except ValueError:
+            print(f"Invalid exit status: {sys.argv[3]}", file=sys.stderr)
+            sys.exit(1)
+        stdout = '' if sys.stdin.isatty() else sys.stdin.read()
+        stderr = ''
+    else:
+        # Reconstruct the command from arguments
+        user_command = ' '.join(sys.argv[1:])
 
-    # Execute the user's command
-    stdout, stderr, exit_status = execute_shell_command(user_command)
+        # Execute the user's command
+        stdout, stderr, exit_status = execute_shell_command(user_command)
 
-    # Output the command result to the terminal
-    print(stdout, end='')  # stdout may already contain newlines
-    if stderr:
-        print(stderr, end='', file=sys.stderr)
+        # Output the command result to the terminal
+        print(stdout, end='')  # stdout may already contain newlines
+        if stderr:
+            print(stderr, end='', file=sys.stderr)
 
     # If the command failed, proceed to interact with the assistant
     if exit_status != 0:
-        # Create assistant if not exists
-        assistant_id = create_assistant_if_not_exists(config)
+        configure_logging()
+
+        # Gather the error details in the background while the client and
+        # assistant are set up; the two are independent
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            error_details_future = executor.submit(
+                gather_error_details, user_command, exit_status, stdout, stderr
+            )
+
+            # Load configuration
+            config = load_config()
+
+            client = create_client()
+
+            # Create assistant if not exists
+            assistant_id = create_assistant_if_not_exists(client, config)
+
+            error_details = error_details_future.result()
+
+        # Post the error details to the session's thread, creating it if needed
+        thread_id = get_or_create_thread(client, error_details)
 
-        # Create thread if not exists
         # Log the error details
-        error_details = gather_error_details(user_command, exit_status, stdout, stderr)
-        thread = create_thread(error_details)
-        
         log_error(error_details)
 
         # Initiate a run with the assistant
-        initiate_run(user_command, assistant_id, thread)
-        # Monitor and handle the run
-        # monitor_run(run, thread)
+        initiate_run(client, user_command, assistant_id, thread_id)
 
     sys.exit(exit_status)
 